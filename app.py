@@ -1,17 +1,20 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List
+import itertools
 import json
 import os
 
-def get_insurer_colors(insurers):
+@st.cache_data(show_spinner=False)
+def get_insurer_colors(insurers: tuple):
     """Create a consistent color mapping for insurers using Plotly's qualitative colors"""
     colors = px.colors.qualitative.Set2
     return {insurer: colors[i % len(colors)] for i, insurer in enumerate(sorted(insurers))}
 
-@dataclass
+@dataclass(slots=True)
 class InsurancePlan:
     name: str
     type: str
@@ -22,6 +25,15 @@ class InsurancePlan:
     referral_needed: bool
     cost_sharing: Dict
     services_covered_before_deductible: List[str]
+    # Derived in __post_init__ for the cost calculations; not serialized
+    annual_premium: float = field(init=False, repr=False, compare=False)
+    deductible_overall: float = field(init=False, repr=False, compare=False)
+    oop_individual: float = field(init=False, repr=False, compare=False)
+    services_covered_set: frozenset = field(init=False, repr=False, compare=False)
+    in_network: Dict = field(init=False, repr=False, compare=False)
+    copay_mask: Dict = field(init=False, repr=False, compare=False)
+    cost_arrays: tuple = field(init=False, repr=False, compare=False)
+    missing_cost_sharing: np.ndarray = field(init=False, repr=False, compare=False)
 
     def to_dict(self):
         return {
@@ -36,26 +48,13 @@ class InsurancePlan:
             "services_covered_before_deductible": self.services_covered_before_deductible
         }
 
-# Initialize session state for plans if it doesn't exist
-if 'plans' not in st.session_state:
-    st.session_state.plans = {}
-    # Load plans from JSON if file exists
-    if os.path.exists('plans.json'):
-        with open('plans.json', 'r') as f:
-            plans_data = json.load(f)
-            for plan_data in plans_data['plans']:
-                plan = InsurancePlan(
-                    name=plan_data['plan_name'],
-                    type=plan_data['plan_type'],
-                    insurer=plan_data['insurer'],
-                    premium=plan_data['premium'],
-                    deductibles=plan_data['deductibles'],
-                    out_of_pocket_limit=plan_data['out_of_pocket_limit'],
-                    referral_needed=plan_data['referral_needed'],
-                    cost_sharing=plan_data['cost_sharing'],
-                    services_covered_before_deductible=plan_data.get('services_covered_before_deductible', [])
-                )
-                st.session_state.plans[plan.name] = plan
+    def __post_init__(self):
+        self.annual_premium = self.premium * 12
+        self.deductible_overall = self.deductibles["overall"]
+        self.oop_individual = self.out_of_pocket_limit["individual"]
+        self.services_covered_set = _normalize_covered_services(self.services_covered_before_deductible)
+        _precompute_innet(self)
+        _precompute_cost_arrays(self)
 
 # Define service mapping for cost sharing lookups
 service_mapping = {
@@ -70,114 +69,224 @@ service_mapping = {
     "hospital_stay": "hospital_stay.facility_fee"
 }
 
-def calculate_service_costs(plan: InsurancePlan, usage: Dict[str, int]) -> Dict[str, float]:
-    """Calculate costs for all services while properly tracking deductible and out-of-pocket maximum"""
-    
-    # Initialize tracking variables
-    accumulated_deductible = 0
-    accumulated_total = 0
-    service_costs = {}
-    out_of_pocket_max = plan.out_of_pocket_limit["individual"]
-    deductible = plan.deductibles["overall"]
-    services_covered = plan.services_covered_before_deductible
-    
-    # Define base costs
-    base_service_costs = {
-        "primary_care": 150,
-        "specialist": 250,
-        "urgent_care": 200,
-        "emergency_room": 1000,
-        "lab_work": 300,
-        "generic_drugs": 30,
-        "specialty_drugs": 600,
-        "ambulance": 1200,     
-        "hospital_stay": 2500  
-    }
-    
-    # First pass: Calculate raw costs and track deductible
-    for service, visits in usage.items():
-        if visits == 0:
-            service_costs[service] = 0
-            continue
-            
-        base_cost = base_service_costs[service] * visits
-        
-        # Get cost sharing info
-        mapped_service = service_mapping[service]
-        service_path = mapped_service.split('.')
+def _precompute_innet(plan: InsurancePlan):
+    """Resolve each service's in-network cost sharing once so cost calculations skip the path walk"""
+    plan.in_network = {}
+    plan.copay_mask = {}
+    for service, mapped_service in service_mapping.items():
         cost_info = plan.cost_sharing
-        for path_part in service_path:
-            cost_info = cost_info[path_part]
-        in_network = cost_info["in_network"]
-        
-        # Calculate service cost based on type of cost sharing
-        if "copay" in in_network:
-            # If service has a copay, use it directly
-            service_costs[service] = visits * in_network["copay"]
-        elif service in ["generic_drugs", "specialty_drugs"]:
-            # Handle prescription drugs separately
-            if service == "generic_drugs":
-                service_costs[service] = visits * in_network["retail_copay"]
+        try:
+            for path_part in mapped_service.split('.'):
+                cost_info = cost_info[path_part]
+            in_network = cost_info["in_network"]
+        except KeyError:
+            # Left unresolved; _precompute_cost_arrays marks it and using it raises in _plan_costs
+            continue
+        plan.in_network[service] = in_network
+        plan.copay_mask[service] = "copay" in in_network
+
+def _precompute_cost_arrays(plan: InsurancePlan):
+    """Pack the resolved cost sharing into per-service arrays (in service_mapping order) for _compute_costs"""
+    copay = np.zeros(len(service_mapping))
+    coinsurance = np.zeros(len(service_mapping))
+    retail_max = np.zeros(len(service_mapping))
+    # Rows: fixed copay, capped drug coinsurance, coinsurance covered before deductible
+    flags = np.zeros((3, len(service_mapping)), dtype=bool)
+    plan.missing_cost_sharing = np.zeros(len(service_mapping), dtype=bool)
+    for i, service in enumerate(service_mapping):
+        try:
+            in_network = plan.in_network[service]
+            if plan.copay_mask[service]:
+                copay[i] = in_network["copay"]
+                flags[0, i] = True
+            elif service == "generic_drugs":
+                copay[i] = in_network["retail_copay"]
+                flags[0, i] = True
+            elif service == "specialty_drugs":
+                coinsurance[i] = in_network["retail_coinsurance"] / 100
+                retail_max[i] = in_network["retail_max"]
+                flags[1, i] = True
             else:
-                coinsurance = in_network["retail_coinsurance"] / 100
-                retail_max = in_network["retail_max"]
-                service_costs[service] = min(base_cost * coinsurance, visits * retail_max)
+                coinsurance[i] = in_network["coinsurance"] / 100
+                flags[2, i] = service in plan.services_covered_set
+        except KeyError:
+            # The plan can't price this service; _plan_costs raises if it is actually used
+            plan.missing_cost_sharing[i] = True
+    plan.cost_arrays = (copay, coinsurance, retail_max, flags)
+
+# Map "services covered before deductible" labels (as used by the Add Plan form and
+# plans.json) to the service keys used in cost calculations
+covered_service_labels = {
+    "Primary Care": ("primary_care",),
+    "Specialist Visit": ("specialist",),
+    "Diagnostic Test": ("lab_work",),
+    "Diagnostic Tests": ("lab_work",),
+    "Prescription Drugs": ("generic_drugs", "specialty_drugs")
+}
+
+def _normalize_covered_services(services: List[str]) -> frozenset:
+    """Convert pre-deductible service labels to service keys; labels for services that aren't modeled are dropped"""
+    normalized = set()
+    for service in services:
+        if service in service_mapping:
+            normalized.add(service)
         else:
-            # Handle coinsurance
-            if service in services_covered:
-                service_costs[service] = base_cost * (in_network["coinsurance"] / 100)
-            else:
-                # Service is subject to deductible
-                remaining_deductible = max(0, deductible - accumulated_deductible)
-                if remaining_deductible > 0:
-                    # Part or all of the cost goes to deductible
-                    deductible_portion = min(base_cost, remaining_deductible)
-                    accumulated_deductible += deductible_portion
-                    
-                    if base_cost > deductible_portion:
-                        # Calculate cost sharing for amount above deductible
-                        remaining_cost = base_cost - deductible_portion
-                        if "copay" in in_network:
-                            service_costs[service] = deductible_portion + (visits * in_network["copay"])
-                        else:
-                            service_costs[service] = deductible_portion + (remaining_cost * (in_network["coinsurance"] / 100))
-                    else:
-                        service_costs[service] = deductible_portion
-                else:
-                    # Deductible already met
-                    if "copay" in in_network:
-                        service_costs[service] = visits * in_network["copay"]
-                    else:
-                        service_costs[service] = base_cost * (in_network["coinsurance"] / 100)
+            normalized.update(covered_service_labels.get(service, ()))
+    return frozenset(normalized)
+
+@st.cache_resource(show_spinner=False)
+def _load_plans_from_disk(path: str, mtime: float) -> Dict[str, InsurancePlan]:
+    """Parse plans from a JSON file once per process; mtime is part of the cache key so edits reload it"""
+    plans = {}
+    with open(path, 'rb') as f:
+        plans_data = json.load(f)
+        for plan_data in plans_data['plans']:
+            plan = InsurancePlan(
+                name=plan_data['plan_name'],
+                type=plan_data['plan_type'],
+                insurer=plan_data['insurer'],
+                premium=plan_data['premium'],
+                deductibles=plan_data['deductibles'],
+                out_of_pocket_limit=plan_data['out_of_pocket_limit'],
+                referral_needed=plan_data['referral_needed'],
+                cost_sharing=plan_data['cost_sharing'],
+                # plans.json lists these under "deductibles"; fall back to the top-level key
+                services_covered_before_deductible=plan_data['deductibles'].get(
+                    'services_covered_before_deductible',
+                    plan_data.get('services_covered_before_deductible', [])
+                )
+            )
+            plans[plan.name] = plan
+    return plans
+
+@st.cache_resource(show_spinner=False)
+def _plans_version_counter():
+    """Process-wide source of plans versions, so sessions never share a cache key for different plans"""
+    return itertools.count()
+
+def bump_plans_version():
+    """Give the session's plans a new version after they change; cached helpers are keyed on it"""
+    st.session_state.plans_version = next(_plans_version_counter())
+
+# Initialize session state for plans if it doesn't exist
+if 'plans' not in st.session_state:
+    st.session_state.plans = {}
+    # Load plans from JSON if file exists; copy the shared dict so adding or
+    # deleting plans only affects this session
+    if os.path.exists('plans.json'):
+        st.session_state.plans = dict(_load_plans_from_disk('plans.json', os.path.getmtime('plans.json')))
+    bump_plans_version()
+
+# Define base costs
+base_service_costs = {
+    "primary_care": 150,
+    "specialist": 250,
+    "urgent_care": 200,
+    "emergency_room": 1000,
+    "lab_work": 300,
+    "generic_drugs": 30,
+    "specialty_drugs": 600,
+    "ambulance": 1200,
+    "hospital_stay": 2500
+}
+
+# Share of total medical cost per service for the cost curve's low (<=$1000),
+# medium ($1000-$5000) and high ($5000+) tiers
+curve_service_mix = {
+    "primary_care": (0.6, 0.3, 0),
+    "specialist": (0, 0.3, 0.15),
+    "urgent_care": (0, 0.2, 0),
+    "emergency_room": (0, 0, 0.2),
+    "lab_work": (0, 0.1, 0.15),
+    "generic_drugs": (0.4, 0.1, 0),
+    "specialty_drugs": (0, 0, 0.1),
+    "ambulance": (0, 0, 0),
+    "hospital_stay": (0, 0, 0.4)
+}
+
+# Base costs, row positions and cost curve shares as per-service arrays used by _compute_costs
+_BASE_COSTS = np.array([base_service_costs[service] for service in service_mapping], dtype=float)
+_SERVICE_INDEX = {service: i for i, service in enumerate(service_mapping)}
+_CURVE_SHARES = np.array([curve_service_mix[service] for service in service_mapping])
+
+# The cost curve always spans $0-$50,000 in 100 steps, so its synthesized usage is computed once:
+# pick the cost tier for each point, then split the cost between services by that tier's shares
+_CURVE_X = np.linspace(0, 50000, 101)
+_CURVE_TIER = np.where(_CURVE_X <= 1000, 0, np.where(_CURVE_X <= 5000, 1, 2))
+# Round all values to nearest whole number since visits can't be fractional
+_CURVE_VISITS = np.round(_CURVE_X * _CURVE_SHARES[:, _CURVE_TIER] / _BASE_COSTS[:, None])
+
+def _compute_costs(base, visits, copay, coinsurance, retail_max, flags, deductible, out_of_pocket_max):
+    """Apply cost sharing to per-service visit counts (one column per scenario), capped at the out-of-pocket max"""
+    is_copay, is_capped_coinsurance, is_pre_deductible = flags
+    raw_costs = visits * base[:, None]
+    costs = np.zeros_like(raw_costs)
+    accumulated_deductible = np.zeros(visits.shape[1])
+    
+    # Services are processed in order since each one uses up part of the deductible
+    for i in range(len(base)):
+        if is_copay[i]:
+            costs[i] = visits[i] * copay[i]
+        elif is_capped_coinsurance[i]:
+            costs[i] = np.minimum(raw_costs[i] * coinsurance[i], visits[i] * retail_max[i])
+        elif is_pre_deductible[i]:
+            costs[i] = raw_costs[i] * coinsurance[i]
+        else:
+            # Part of the cost goes to the remaining deductible, coinsurance applies to the rest
+            remaining_deductible = np.maximum(0, deductible - accumulated_deductible)
+            deductible_portion = np.minimum(raw_costs[i], remaining_deductible)
+            accumulated_deductible += deductible_portion
+            costs[i] = deductible_portion + (raw_costs[i] - deductible_portion) * coinsurance[i]
+    
+    # Scale costs down proportionally to exactly hit the out-of-pocket max where it's exceeded
+    total = costs.sum(axis=0)
+    over_max = total > out_of_pocket_max
+    if over_max.any():
+        costs[:, over_max] *= out_of_pocket_max / total[over_max]
         
-        accumulated_total += service_costs[service]
+        # Verify total medical costs exactly equal the out-of-pocket max (skipped under python -O)
+        if __debug__:
+            total_medical = costs[:, over_max].sum(axis=0)
+            assert np.all(np.abs(total_medical - out_of_pocket_max) < 0.01), "Medical costs exceed out-of-pocket maximum"
     
-    # Second pass: Adjust for out-of-pocket maximum if needed
-    if accumulated_total > out_of_pocket_max:
-        # Scale all costs down proportionally to exactly hit the out-of-pocket max
-        adjustment_ratio = out_of_pocket_max / accumulated_total
-        for service in service_costs:
-            service_costs[service] *= adjustment_ratio
-            
-        # Verify total medical costs exactly equal the out-of-pocket max
-        total_medical = sum(service_costs.values())
-        assert abs(total_medical - out_of_pocket_max) < 0.01, "Medical costs exceed out-of-pocket maximum"
+    return costs
+
+def _plan_costs(plan: InsurancePlan, visits: np.ndarray) -> np.ndarray:
+    """Run _compute_costs for a plan, failing loudly if a used service has no cost sharing data"""
+    missing = plan.missing_cost_sharing & visits.any(axis=1)
+    if missing.any():
+        service = list(service_mapping)[missing.argmax()]
+        raise KeyError(f"Plan '{plan.name}' has no usable in-network cost sharing for {service}")
     
-    return service_costs
+    return _compute_costs(
+        _BASE_COSTS, visits, *plan.cost_arrays,
+        plan.deductible_overall, plan.oop_individual
+    )
+
+def calculate_service_costs(plan: InsurancePlan, usage: Dict[str, int]) -> Dict[str, float]:
+    """Calculate costs for all services while properly tracking deductible and out-of-pocket maximum"""
+    visits = np.zeros((len(_BASE_COSTS), 1))
+    for service, count in usage.items():
+        visits[_SERVICE_INDEX[service], 0] = count
+    
+    costs = _plan_costs(plan, visits)
+    return {service: costs[_SERVICE_INDEX[service], 0].item() for service in usage}
 
 def calculate_annual_cost(plan: InsurancePlan, usage: Dict[str, int]) -> Dict[str, float]:
     """Calculate total annual cost including premium"""
     # Premium calculation
-    annual_premium = plan.premium * 12
+    annual_premium = plan.annual_premium
     
     # Get costs for all services (this will be capped at out-of-pocket max)
     service_costs = calculate_service_costs(plan, usage)
     total_medical_costs = sum(service_costs.values())
     
-    # Verify total cost never exceeds premium + out-of-pocket max
     total_cost = annual_premium + total_medical_costs
-    max_possible_cost = annual_premium + plan.out_of_pocket_limit["individual"]
-    assert total_cost <= max_possible_cost + 0.01, f"Total cost {total_cost} exceeds maximum possible {max_possible_cost}"
+    
+    # Verify total cost never exceeds premium + out-of-pocket max (skipped under python -O)
+    if __debug__:
+        max_possible_cost = annual_premium + plan.oop_individual
+        assert total_cost <= max_possible_cost + 0.01, f"Total cost {total_cost} exceeds maximum possible {max_possible_cost}"
     
     return {
         "annual_premium": annual_premium,
@@ -186,54 +295,169 @@ def calculate_annual_cost(plan: InsurancePlan, usage: Dict[str, int]) -> Dict[st
         "service_costs": service_costs
     }
 
-def generate_cost_curve_data(plan: InsurancePlan, max_medical_cost: float = 50000, points: int = 100) -> tuple:
+def generate_cost_curve_data(plan: InsurancePlan) -> tuple:
     """Generate data points for cost curve visualization"""
-    medical_costs = [i * (max_medical_cost / points) for i in range(points + 1)]
-    total_costs = []
+    service_costs = _plan_costs(plan, _CURVE_VISITS)
+    total_costs = plan.annual_premium + service_costs.sum(axis=0)
     
-    for raw_cost in medical_costs:
-        # Create a realistic distribution of services that adds up to the target cost
-        usage = {
-            "primary_care": 0,
-            "specialist": 0,
-            "urgent_care": 0,
-            "emergency_room": 0,
-            "lab_work": 0,
-            "generic_drugs": 0,
-            "specialty_drugs": 0,
-            "ambulance": 0,
-            "hospital_stay": 0
-        }
-        
-        if raw_cost > 0:
-            # For low costs (<$1000), mostly primary care and generic drugs
-            if raw_cost <= 1000:
-                usage["primary_care"] = (raw_cost * 0.6) / 150  # 60% primary care
-                usage["generic_drugs"] = (raw_cost * 0.4) / 30  # 40% generic drugs
-            
-            # For medium costs ($1000-$5000), add specialists and some urgent care
-            elif raw_cost <= 5000:
-                usage["primary_care"] = (raw_cost * 0.3) / 150
-                usage["specialist"] = (raw_cost * 0.3) / 250
-                usage["urgent_care"] = (raw_cost * 0.2) / 200
-                usage["generic_drugs"] = (raw_cost * 0.1) / 30
-                usage["lab_work"] = (raw_cost * 0.1) / 300
+    return _CURVE_X, total_costs
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def cached_annual_cost(plans_version: int, plan_name: str, usage_items: tuple, _plan: InsurancePlan) -> Dict[str, float]:
+    """Cached wrapper around calculate_annual_cost keyed by plans version, plan name and usage"""
+    return calculate_annual_cost(_plan, dict(usage_items))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_cost_curve_figure(plans_version: int, _plans: tuple):
+    """Build the cost curve figure for a plans version, with plans in display order"""
+    # Generate cost curve data for each plan
+    curves = [generate_cost_curve_data(plan) for plan in _plans]
+    insurer_colors = get_insurer_colors(tuple(dict.fromkeys(plan.insurer for plan in _plans)))
+    
+    # Stack the per-plan arrays into flat columns
+    cost_curve_df = pd.DataFrame({
+        'Medical Costs': np.concatenate([medical_costs for medical_costs, _ in curves]),
+        'Out of Pocket': np.concatenate([out_of_pocket_costs for _, out_of_pocket_costs in curves]),
+        'Plan': np.repeat([plan.name for plan in _plans], len(_CURVE_X)),
+        'Insurer': np.repeat([plan.insurer for plan in _plans], len(_CURVE_X))
+    })
+    
+    # Create line plot with same colors
+    fig_curve = px.line(cost_curve_df,
+                        x='Medical Costs',
+                        y='Out of Pocket',
+                        color='Insurer',
+                        line_dash='Plan',
+                        title='Total Costs vs Medical Costs',
+                        color_discrete_map=insurer_colors)
+    
+    # Update hover template
+    fig_curve.update_traces(
+        hovertemplate="%{data.name}<br>Total cost: $%{y:,.2f}<extra></extra>",
+    )
+    
+    fig_curve.update_layout(
+        xaxis_title="Total Medical Costs (Before Insurance) ($)",
+        yaxis_title="Total Annual Cost (Premium + Out of Pocket) ($)",
+        hovermode='x unified',
+        height=600,
+        legend=dict(orientation="h")
+    )
+    
+    # Format axis labels to show currency
+    fig_curve.update_layout(
+        xaxis=dict(tickformat="$,.0f"),
+        yaxis=dict(tickformat="$,.0f")
+    )
+    
+    return fig_curve
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _group_sorted(plans_version: int, _plans: Dict[str, InsurancePlan]) -> Dict[str, List[str]]:
+    """Group plan names by insurer, ordered by insurer name and then by premium"""
+    grouped = {}
+    for plan in _plans.values():
+        grouped.setdefault(plan.insurer, []).append(plan)
+    # Insert insurers in sorted order and sort each insurer's plans once, so callers can iterate as-is
+    return {
+        insurer: [plan.name for plan in sorted(insurer_plans, key=lambda plan: plan.premium)]
+        for insurer, insurer_plans in sorted(grouped.items())
+    }
+
+def group_plans_by_insurer(plans_version: int, plans: Dict[str, InsurancePlan]) -> Dict[str, List[InsurancePlan]]:
+    """Group plans by insurer using the ordering cached for this plans version"""
+    grouped = _group_sorted(plans_version, plans)
+    return {insurer: [plans[name] for name in names] for insurer, names in grouped.items()}
+
+def _render_compare(usage_items: tuple, plans_version: int, insurers: Dict[str, List[InsurancePlan]]):
+    """Render the cost comparison table and bar chart, which depend on the usage scenario"""
+    # Build results columns maintaining the sorting
+    service_columns = {
+        "Primary Care": "primary_care",
+        "Specialist": "specialist",
+        "Urgent Care": "urgent_care",
+        "Emergency Room": "emergency_room",
+        "Ambulance": "ambulance",
+        "Hospital Stay": "hospital_stay",
+        "Lab Work": "lab_work",
+        "Generic Drugs": "generic_drugs",
+        "Specialty Drugs": "specialty_drugs"
+    }
+    results = {
+        column: [] for column in
+        ["Insurer", "Plan", "Monthly Premium", "Annual Premium", *service_columns, "Medical Costs", "Total Cost"]
+    }
+    for insurer_plans in insurers.values():
+        for plan in insurer_plans:
+            # Calculate costs including service breakdown
+            costs = cached_annual_cost(plans_version, plan.name, usage_items, plan)
             
-            # For high costs ($5000+), include more expensive services
-            else:
-                usage["hospital_stay"] = (raw_cost * 0.4) / 2500
-                usage["emergency_room"] = (raw_cost * 0.2) / 1000
-                usage["specialist"] = (raw_cost * 0.15) / 250
-                usage["lab_work"] = (raw_cost * 0.15) / 300
-                usage["specialty_drugs"] = (raw_cost * 0.1) / 600
-        
-        # Round all values to nearest whole number since visits can't be fractional
-        usage = {k: round(max(0, v)) for k, v in usage.items()}
-        
-        annual_costs = calculate_annual_cost(plan, usage)
-        total_costs.append(annual_costs["total_cost"])
+            results["Insurer"].append(plan.insurer)
+            results["Plan"].append(plan.name)
+            results["Monthly Premium"].append(plan.premium)
+            results["Annual Premium"].append(costs["annual_premium"])
+            for column, service in service_columns.items():
+                results[column].append(costs["service_costs"].get(service, 0))
+            results["Medical Costs"].append(costs["medical_costs"])
+            results["Total Cost"].append(costs["total_cost"])
+    
+    results_df = pd.DataFrame(results)
+    
+    # Display results table with better formatting
+    st.subheader("Cost Comparison")
+    st.dataframe(
+        results_df,
+        column_config={
+            "Insurer": st.column_config.TextColumn("Insurer"),
+            "Plan": st.column_config.TextColumn("Plan"),
+            "Monthly Premium": st.column_config.NumberColumn("Monthly Premium", format="dollar"),
+            "Annual Premium": st.column_config.NumberColumn("Annual Premium", format="dollar"),
+            "Primary Care": st.column_config.NumberColumn("Primary Care", format="dollar"),
+            "Specialist": st.column_config.NumberColumn("Specialist", format="dollar"),
+            "Urgent Care": st.column_config.NumberColumn("Urgent Care", format="dollar"),
+            "Emergency Room": st.column_config.NumberColumn("Emergency Room", format="dollar"),
+            "Ambulance": st.column_config.NumberColumn("Ambulance", format="dollar"),
+            "Hospital Stay": st.column_config.NumberColumn("Hospital Stay", format="dollar"),
+            "Lab Work": st.column_config.NumberColumn("Lab Work", format="dollar"),
+            "Generic Drugs": st.column_config.NumberColumn("Generic Drugs", format="dollar"),
+            "Specialty Drugs": st.column_config.NumberColumn("Specialty Drugs", format="dollar"),
+            "Medical Costs": st.column_config.NumberColumn("Medical Costs", format="dollar"),
+            "Total Cost": st.column_config.NumberColumn("Total Cost", format="dollar")
+        },
+        hide_index=True
+    )
+    
+    # Get consistent colors for insurers
+    insurer_colors = get_insurer_colors(tuple(insurers))
+    
+    # Display bar chart with color by insurer
+    fig = px.bar(results_df, 
+                x="Plan", 
+                y="Total Cost",
+                color="Insurer",
+                title="Annual Cost Comparison",
+                color_discrete_map=insurer_colors)
+    fig.update_layout(yaxis_title="Total Cost ($)")
+    st.plotly_chart(fig)
 
-    return medical_costs, total_costs
+def _render_curves(plans_version: int, insurers: Dict[str, List[InsurancePlan]]):
+    """Render the cost sharing analysis, which only depends on the plans"""
+    # Add cost curve visualization
+    st.subheader("Cost Sharing Analysis")
+    st.write(
+        """
+        This chart shows how out-of-pocket costs scale with total medical costs for each plan.
+        - For low costs (<\\$1000), the model assumes 60% primary care and 40% generic drugs.
+        - For medium costs (\\$1000-\\$5000), the model assumes 30% primary care, 30% specialist, 20% urgent care, 10% lab work, 10% generic drugs.
+        - For high costs (\\$5000+), the model assumes 40% hospital stay, 20% emergency room, 15% specialist, 15% lab work, 10% specialty drugs.
+        
+        Use the chart's scaling features to zoom in on your area of interest.
+        """
+    )
+    
+    # The cost curve only depends on the plans, so the figure is cached on the plans version
+    curve_plans = tuple(plan for insurer_plans in insurers.values() for plan in insurer_plans)
+    st.plotly_chart(build_cost_curve_figure(plans_version, curve_plans))
 
 def main():
     st.set_page_config(
@@ -300,164 +524,11 @@ def main():
         if not st.session_state.plans:
             st.info("Please add some insurance plans in the 'Manage Plans' tab or in a `plans.json` file to get started.")
         else:
-            # Group plans by insurer
-            insurers = {}
-            for plan_name, plan in st.session_state.plans.items():
-                if plan.insurer not in insurers:
-                    insurers[plan.insurer] = []
-                insurers[plan.insurer].append(plan)
-            
-            # Sort plans within each insurer by premium
-            for insurer in insurers:
-                insurers[insurer].sort(key=lambda x: x.premium)
-            
-            # Create results list maintaining the sorting
-            results = []
-            for insurer in sorted(insurers.keys()):
-                for plan in insurers[insurer]:
-                    # Calculate costs including service breakdown
-                    costs = calculate_annual_cost(plan, usage)
-                    
-                    results.append({
-                        "Insurer": plan.insurer,
-                        "Plan": plan.name,
-                        "Monthly Premium": plan.premium,
-                        "Annual Premium": costs["annual_premium"],
-                        "Primary Care": costs["service_costs"].get("primary_care", 0),
-                        "Specialist": costs["service_costs"].get("specialist", 0),
-                        "Urgent Care": costs["service_costs"].get("urgent_care", 0),
-                        "Emergency Room": costs["service_costs"].get("emergency_room", 0),
-                        "Ambulance": costs["service_costs"].get("ambulance", 0),
-                        "Hospital Stay": costs["service_costs"].get("hospital_stay", 0),
-                        "Lab Work": costs["service_costs"].get("lab_work", 0),
-                        "Generic Drugs": costs["service_costs"].get("generic_drugs", 0),
-                        "Specialty Drugs": costs["service_costs"].get("specialty_drugs", 0),
-                        "Medical Costs": costs["medical_costs"],
-                        "Total Cost": costs["total_cost"]
-                    })
-            
-            results_df = pd.DataFrame(results)
-            
-            # Format currency columns
-            currency_columns = [
-                "Monthly Premium", "Annual Premium", "Primary Care", "Specialist",
-                "Urgent Care", "Emergency Room", "Ambulance", "Hospital Stay",
-                "Lab Work", "Generic Drugs", "Specialty Drugs", "Medical Costs", "Total Cost"
-            ]
-            for col in currency_columns:
-                results_df[col] = results_df[col].apply(lambda x: f"${x:,.2f}")
-            
-            # Display results table with better formatting
-            st.subheader("Cost Comparison")
-            st.dataframe(
-                results_df,
-                column_config={
-                    "Insurer": st.column_config.TextColumn("Insurer"),
-                    "Plan": st.column_config.TextColumn("Plan"),
-                    "Monthly Premium": st.column_config.TextColumn("Monthly Premium"),
-                    "Annual Premium": st.column_config.TextColumn("Annual Premium"),
-                    "Primary Care": st.column_config.TextColumn("Primary Care"),
-                    "Specialist": st.column_config.TextColumn("Specialist"),
-                    "Urgent Care": st.column_config.TextColumn("Urgent Care"),
-                    "Emergency Room": st.column_config.TextColumn("Emergency Room"),
-                    "Ambulance": st.column_config.TextColumn("Ambulance"),
-                    "Hospital Stay": st.column_config.TextColumn("Hospital Stay"),
-                    "Lab Work": st.column_config.TextColumn("Lab Work"),
-                    "Generic Drugs": st.column_config.TextColumn("Generic Drugs"),
-                    "Specialty Drugs": st.column_config.TextColumn("Specialty Drugs"),
-                    "Medical Costs": st.column_config.TextColumn("Medical Costs"),
-                    "Total Cost": st.column_config.TextColumn("Total Cost")
-                },
-                hide_index=True
-            )
-            
-            # Convert currency strings back to float for plotting
-            plot_df = results_df.copy()
-            for col in currency_columns:
-                plot_df[col] = plot_df[col].str.replace('$', '').str.replace(',', '').astype(float)
-            
-            # Get consistent colors for insurers
-            insurer_colors = get_insurer_colors(insurers.keys())
-            
-            # Display bar chart with color by insurer
-            fig = px.bar(plot_df, 
-                        x="Plan", 
-                        y="Total Cost",
-                        color="Insurer",
-                        title="Annual Cost Comparison",
-                        color_discrete_map=insurer_colors)
-            fig.update_layout(yaxis_title="Total Cost ($)")
-            st.plotly_chart(fig)
-            
-            # Add cost curve visualization
-            st.subheader("Cost Sharing Analysis")
-            st.write(
-                """
-                This chart shows how out-of-pocket costs scale with total medical costs for each plan.
-                - For low costs (<\\$1000), the model assumes 60% primary care and 40% generic drugs.
-                - For medium costs (\\$1000-\\$5000), the model assumes 30% primary care, 30% specialist, 20% urgent care, 10% lab work, 10% generic drugs.
-                - For high costs (\\$5000+), the model assumes 40% hospital stay, 20% emergency room, 15% specialist, 15% lab work, 10% specialty drugs.
-                
-                Use the chart's scaling features to zoom in on your area of interest.
-                """
-            )
+            # Group plans by insurer, sorted by premium within each insurer
+            insurers = group_plans_by_insurer(st.session_state.plans_version, st.session_state.plans)
             
-            # Generate cost curve data for each plan
-            cost_curve_data = []
-            
-            # Group plans by insurer and sort insurers
-            insurers = {}
-            for plan_name, plan in st.session_state.plans.items():
-                if plan.insurer not in insurers:
-                    insurers[plan.insurer] = []
-                insurers[plan.insurer].append(plan)
-            
-            # Sort plans within each insurer by premium
-            for insurer in insurers:
-                insurers[insurer].sort(key=lambda x: x.premium)
-            
-            # Generate data in sorted order
-            for insurer in sorted(insurers.keys()):
-                for plan in insurers[insurer]:
-                    medical_costs, out_of_pocket_costs = generate_cost_curve_data(plan)
-                    cost_curve_data.extend([{
-                        'Medical Costs': med,
-                        'Out of Pocket': oop,
-                        'Plan': plan.name,
-                        'Insurer': plan.insurer
-                    } for med, oop in zip(medical_costs, out_of_pocket_costs)])
-            
-            cost_curve_df = pd.DataFrame(cost_curve_data)
-            
-            # Create line plot with same colors
-            fig_curve = px.line(cost_curve_df,
-                              x='Medical Costs',
-                              y='Out of Pocket',
-                              color='Insurer',
-                              line_dash='Plan',
-                              title='Total Costs vs Medical Costs',
-                              color_discrete_map=insurer_colors)
-            
-            # Update hover template
-            fig_curve.update_traces(
-                hovertemplate="%{data.name}<br>Total cost: $%{y:,.2f}<extra></extra>",
-            )
-            
-            fig_curve.update_layout(
-                xaxis_title="Total Medical Costs (Before Insurance) ($)",
-                yaxis_title="Total Annual Cost (Premium + Out of Pocket) ($)",
-                hovermode='x unified',
-                height=600,
-                legend=dict(orientation="h")
-            )
-            
-            # Format axis labels to show currency
-            fig_curve.update_layout(
-                xaxis=dict(tickformat="$,.0f"),
-                yaxis=dict(tickformat="$,.0f")
-            )
-            
-            st.plotly_chart(fig_curve)
+            _render_compare(tuple(usage.items()), st.session_state.plans_version, insurers)
+            _render_curves(st.session_state.plans_version, insurers)
     
     # Tab 2: Manage Plans
     with tab2:
@@ -594,36 +665,27 @@ def main():
                         services_covered_before_deductible=services_covered
                     )
                     st.session_state.plans[name] = new_plan
+                    bump_plans_version()
                     st.success(f"Added plan: {name}")
         
         # Display existing plans
         st.subheader("Existing Plans")
         
         with st.container(border=True):
-            # Group plans by insurer
-            insurers = {}
-            for plan_name, plan in st.session_state.plans.items():
-                if plan.insurer not in insurers:
-                    insurers[plan.insurer] = []
-                insurers[plan.insurer].append(plan)
+            # Group plans by insurer, sorted by premium within each insurer
+            insurers = group_plans_by_insurer(st.session_state.plans_version, st.session_state.plans)
             
             # Create list of plans to delete
             plans_to_delete = []
             
             # Display plans grouped by insurer
-            for insurer in sorted(insurers.keys()):
+            for insurer, insurer_plans in insurers.items():
                 st.write(f"#### {insurer}")
                 
-                # Sort plans by premium
-                insurers[insurer].sort(key=lambda x: x.premium)
-                
-                # Get list of plan names for this insurer (now in premium order)
-                insurer_plans = [plan.name for plan in insurers[insurer]]
-                
-                # Create multi-select for deletion
+                # Create multi-select for deletion (options in premium order)
                 selected = st.multiselect(
                     "Select plans to delete",
-                    options=insurer_plans,
+                    options=[plan.name for plan in insurer_plans],
                     key=f"delete_{insurer}"  # Unique key for each insurer's multiselect
                 )
                 
@@ -631,7 +693,7 @@ def main():
                 plans_to_delete.extend(selected)
                 
                 # Display plan details in a clean format (already sorted by premium)
-                for plan in insurers[insurer]:
+                for plan in insurer_plans:
                     st.write(f"- {plan.name} ({plan.type}): ${plan.premium:.2f}/month")
             
         # Add delete button if plans are selected
@@ -639,6 +701,7 @@ def main():
             if st.button(f"Delete {len(plans_to_delete)} selected plan(s)", type="primary"):
                 for plan_name in plans_to_delete:
                     del st.session_state.plans[plan_name]
+                bump_plans_version()
                 st.rerun()
 
 if __name__ == "__main__":